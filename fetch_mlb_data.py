@@ -1,8 +1,47 @@
 
 import os
-import requests
+import sys
+import io
+import csv
+import hashlib
+import threading
+import orjson
+try:
+    # yajl2_c is the fastest ijson backend; fall back to the default
+    # pure-Python one where libyajl isn't available.
+    import ijson.backends.yajl2_c as ijson
+except ImportError:
+    import ijson
+import requests_cache
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, asdict
 from datetime import datetime, timezone, timedelta
 from supabase import create_client
+try:
+    # Only needed for the direct COPY path on large loads; the PostgREST
+    # path works without it.
+    import psycopg2
+except ImportError:
+    psycopg2 = None
+
+# --- Shared HTTP session ---
+# One session for every MLB API call so the TLS connection to
+# statsapi.mlb.com is reused instead of re-handshaking per request.
+# The on-disk cache serves repeat cron runs within the TTL straight
+# from SQLite, and cache_control honors the API's own Cache-Control
+# and ETag revalidation headers.
+SESSION = requests_cache.CachedSession("mlb_cache.sqlite", expire_after=300, cache_control=True)
+SESSION.mount("https://", HTTPAdapter(
+    pool_connections=4,
+    pool_maxsize=32,
+    max_retries=Retry(total=3, backoff_factor=0.3, status_forcelist=[429, 500, 502, 503, 504])
+))
+SESSION.headers.update({
+    "Accept-Encoding": "gzip, deflate",
+    "Connection": "keep-alive"
+})
 
 # --- Supabase client setup ---
 SUPABASE_URL = os.environ.get("SUPABASE_URL")
@@ -10,81 +49,212 @@ SUPABASE_SERVICE_ROLE_KEY = os.environ.get("SUPABASE_SERVICE_ROLE_KEY")
 supabase = create_client(SUPABASE_URL, SUPABASE_SERVICE_ROLE_KEY)
 
 # --- Helper: Upsert into Supabase ---
+# Per-table digest of the last upserted rows, kept between cron runs so
+# an identical payload (common for schedule/standings re-runs) skips
+# the Supabase round-trip entirely.
+SYNC_STATE_PATH = ".sync_state.json"
+
+# The fetchers run concurrently and all share this one file; serialize
+# the load/modify/write cycle so parallel upserts can't clobber each
+# other's digests or read a half-written file.
+_sync_state_lock = threading.Lock()
+
+# Columns that change every run regardless of the underlying data;
+# hashing them would make the digest never match (team_stats embeds a
+# per-run updated_at timestamp).
+VOLATILE_COLS = ("updated_at",)
+
+def _rows_digest(rows, conflict_cols):
+    # Sort by the leading conflict column so row order doesn't change
+    # the hash; blake2b chews through the payload far faster than the
+    # network round-trip it saves.
+    ordered = sorted(rows, key=lambda r: r[conflict_cols[0]] or 0)
+    if any(col in rows[0] for col in VOLATILE_COLS):
+        ordered = [{k: v for k, v in row.items() if k not in VOLATILE_COLS} for row in ordered]
+    return hashlib.blake2b(orjson.dumps(ordered)).hexdigest()
+
+def _read_sync_state():
+    try:
+        with open(SYNC_STATE_PATH, "rb") as f:
+            return orjson.loads(f.read())
+    except (OSError, ValueError):
+        return {}
+
+def _load_sync_state():
+    with _sync_state_lock:
+        return _read_sync_state()
+
+def _record_sync_state(table, digest):
+    with _sync_state_lock:
+        state = _read_sync_state()
+        state[table] = digest
+        with open(SYNC_STATE_PATH, "wb") as f:
+            f.write(orjson.dumps(state))
+
+# Max rows per upsert call; keeps each PostgREST payload well under
+# Supabase's request-size limit and bounds per-call latency.
+UPSERT_BATCH_SIZE = 500
+
+# Above this row count (historical backfills), upsert() switches from
+# PostgREST batches to one COPY over the direct connection. Needs
+# SUPABASE_DB_URL (see README) and psycopg2 installed.
+COPY_THRESHOLD = 1000
+SUPABASE_DB_URL = os.environ.get("SUPABASE_DB_URL")
+
+def _copy_upsert(table: str, rows: list, conflict_cols: list):
+    # COPY into a temp staging table, then merge into the real table in
+    # one statement: a single round-trip, no per-row HTTP framing.
+    cols = list(rows[0].keys())
+    buf = io.StringIO()
+    writer = csv.writer(buf)
+    for row in rows:
+        writer.writerow([row[c] for c in cols])
+    buf.seek(0)
+
+    col_list = ", ".join(cols)
+    conflict_spec = ", ".join(conflict_cols)
+    updates = ", ".join(f"{c} = EXCLUDED.{c}" for c in cols if c not in conflict_cols)
+
+    conn = psycopg2.connect(SUPABASE_DB_URL)
+    try:
+        with conn, conn.cursor() as cur:
+            cur.execute(f"CREATE TEMP TABLE _stage (LIKE {table} INCLUDING DEFAULTS)")
+            cur.copy_expert(f"COPY _stage ({col_list}) FROM STDIN WITH CSV", buf)
+            cur.execute(
+                f"INSERT INTO {table} ({col_list}) SELECT {col_list} FROM _stage "
+                f"ON CONFLICT ({conflict_spec}) DO UPDATE SET {updates}"
+            )
+    finally:
+        conn.close()
+    print(f"[SUCCESS] {len(rows)} rows copied into {table}")
+
 def upsert(table: str, rows: list, conflict_cols: list):
     if not rows:
         print(f"[INFO] No rows to insert for table: {table}")
         return
+
+    digest = _rows_digest(rows, conflict_cols)
+    if _load_sync_state().get(table) == digest:
+        print(f"[INFO] {table} unchanged since last run, skipping upsert")
+        return
     print(f"[INFO] Upserting {len(rows)} rows into {table}")
-    
+
+    if len(rows) > COPY_THRESHOLD and psycopg2 is not None and SUPABASE_DB_URL:
+        try:
+            _copy_upsert(table, rows, conflict_cols)
+            _record_sync_state(table, digest)
+            return
+        except Exception as e:
+            print(f"[WARNING] COPY path failed for {table}, falling back to PostgREST: {e}")
+
     # For composite keys, we need to specify the columns in a specific format
     if len(conflict_cols) > 1:
         # Join multiple columns with comma for composite key
         conflict_spec = ",".join(conflict_cols)
     else:
         conflict_spec = conflict_cols[0]
-    
+
     try:
-        response = supabase.table(table).upsert(rows, on_conflict=conflict_spec).execute()
-        if hasattr(response, "data"):
-            print(f"[SUCCESS] {len(response.data)} rows upserted into {table}")
-        else:
-            print(f"[WARNING] No response data for {table}")
+        for i in range(0, len(rows), UPSERT_BATCH_SIZE):
+            batch = rows[i:i + UPSERT_BATCH_SIZE]
+            # Log what we sent; touching response.data would deserialize
+            # every returned row just for a count.
+            supabase.table(table).upsert(batch, on_conflict=conflict_spec).execute()
+            print(f"[SUCCESS] {len(batch)} rows upserted into {table}")
     except Exception as e:
         print(f"[ERROR] Failed to upsert into {table}: {e}")
         raise
+    _record_sync_state(table, digest)
+
+# --- Generated row extractors ---
+# Each schema entry is (dest_key, source path, required). The factory
+# compiles the schema into one direct-subscript dict literal at import
+# time, so the per-game hot loop runs a single specialized function
+# with no chained lookups or per-field dispatch. A missing required key
+# raises KeyError, which the _*_row wrappers translate into None.
+SCHEMA_GAME = (
+    ("game_id", ("gamePk",), True),
+    ("date", ("gameDate",), True),
+    ("status", ("status", "detailedState"), True),
+    ("home_team", ("teams", "home", "team", "name"), True),
+    ("away_team", ("teams", "away", "team", "name"), True),
+    ("home_score", ("teams", "home", "score"), False),
+    ("away_score", ("teams", "away", "score"), False),
+)
+
+SCHEMA_SCHEDULE = (
+    ("game_id", ("gamePk",), True),
+    ("date", ("gameDate",), True),
+    ("home_team", ("teams", "home", "team", "name"), True),
+    ("away_team", ("teams", "away", "team", "name"), True),
+)
+
+def build_extractor(schema):
+    parts = []
+    for dest, path, required in schema:
+        expr = "g" + "".join(f"[{key!r}]" for key in (path if required else path[:-1]))
+        if not required:
+            expr += f".get({path[-1]!r})"
+        parts.append(f"{dest!r}: {expr}")
+    source = "def _extract(g):\n    return {" + ", ".join(parts) + "}"
+    namespace = {}
+    exec(source, namespace)
+    return namespace["_extract"]
+
+_extract_game = build_extractor(SCHEMA_GAME)
+_extract_schedule_game = build_extractor(SCHEMA_SCHEDULE)
 
 # --- Fetch today's games ---
+def _game_row(game):
+    try:
+        return _extract_game(game)
+    except KeyError:
+        return None
+
 def fetch_games():
     today = datetime.now(timezone.utc).strftime("%Y-%m-%d")
     url = f"https://statsapi.mlb.com/api/v1/schedule?sportId=1&date={today}"
-    r = requests.get(url)
-    data = r.json()
-
-    games = []
-    for date in data.get("dates", []):
-        for game in date.get("games", []):
-            games.append({
-                "game_id": game.get("gamePk"),
-                "date": game.get("gameDate"),
-                "status": game.get("status", {}).get("detailedState"),
-                "home_team": game.get("teams", {}).get("home", {}).get("team", {}).get("name"),
-                "away_team": game.get("teams", {}).get("away", {}).get("team", {}).get("name"),
-                "home_score": game.get("teams", {}).get("home", {}).get("score"),
-                "away_score": game.get("teams", {}).get("away", {}).get("score")
-            })
+    r = SESSION.get(url, timeout=10)
+    data = orjson.loads(r.content)
+
+    rows = (_game_row(game) for date in data.get("dates", []) for game in date.get("games", []))
+    games = [row for row in rows if row is not None]
     upsert("games", games, ["game_id"])
 
 # --- Fetch team standings ---
 def fetch_standings():
     url = "https://statsapi.mlb.com/api/v1/standings?leagueId=103,104"  # AL & NL
-    r = requests.get(url)
-    data = r.json()
+    r = SESSION.get(url, timeout=10)
+    data = orjson.loads(r.content)
 
     # Get season with fallback to current year
     season = data.get("season") or datetime.now().year
 
-    standings = []
-    for record in data.get("records", []):
-        division_name = record.get("division", {}).get("name")
-        for team_record in record.get("teamRecords", []):
-            team = team_record.get("team", {})
-            standings.append({
-                "season": season,
-                "team_id": team_record["team"]["id"],
-                "team_name": team_record["team"]["name"],
-                "division": division_name,
-                "wins": team_record["wins"],
-                "losses": team_record["losses"],
-                "win_pct": float(team_record["winningPercentage"]),
-                "games_back": float(team_record.get("gamesBack", "0").replace("-", "0"))
-            })
+    standings = [
+        {
+            "season": season,
+            "team_id": team_record["team"]["id"],
+            "team_name": team_record["team"]["name"],
+            "division": record.get("division", {}).get("name"),
+            "wins": team_record["wins"],
+            "losses": team_record["losses"],
+            "win_pct": float(team_record["winningPercentage"]),
+            "games_back": float(team_record.get("gamesBack", "0").replace("-", "0"))
+        }
+        for record in data.get("records", [])
+        for team_record in record.get("teamRecords", [])
+    ]
     upsert("standings", standings, ["season", "team_id"])
 
 # --- Fetch player season stats (basic batting) ---
 def fetch_player_stats():
-    url = "https://statsapi.mlb.com/api/v1/stats?stats=season&group=hitting&sportId=1"
-    r = requests.get(url)
-    data = r.json()
+    season = datetime.now(timezone.utc).year
+    url = "https://statsapi.mlb.com/api/v1/stats"
+    # One bulk request returns every player; limit=2000 lifts the API's
+    # default pagination cap so nobody is silently dropped.
+    params = {"stats": "season", "group": "hitting", "sportId": 1, "season": season, "limit": 2000}
+    r = SESSION.get(url, params=params, timeout=10)
+    data = orjson.loads(r.content)
 
     player_stats = []
     for row in data.get("stats", []):
@@ -98,7 +268,7 @@ def fetch_player_stats():
             try:
                 record = {
                     "player_id": int(player.get("id")) if player.get("id") else None,
-                    "season": int(datetime.now().year),
+                    "season": season,
                     "team_id": int(team_info.get("id")) if team_info.get("id") else None,
                     "player_name": str(player.get("fullName")) if player.get("fullName") else None,
                     "games_played": int(stat.get("gamesPlayed", 0)) if stat.get("gamesPlayed") else 0,
@@ -122,38 +292,105 @@ def fetch_player_stats():
     
     upsert("player_season_stats", player_stats, ["player_id", "season"])
 
+def _json_stream(r):
+    # Cache hits hand back a CachedHTTPResponse whose raw stream is not
+    # readable from the start, which makes ijson die with a premature
+    # EOF; rewrap the cached body instead. Live responses stream as-is.
+    if getattr(r, "from_cache", False):
+        return io.BytesIO(r.content)
+    r.raw.decode_content = True
+    return r.raw
+
 # --- Fetch next 7 days' schedule ---
+def _schedule_row(game):
+    try:
+        return _extract_schedule_game(game)
+    except KeyError:
+        return None
+
 def fetch_schedule():
-    start = datetime.now(timezone.utc).strftime("%Y-%m-%d")
-    end = (datetime.now(timezone.utc) + timedelta(days=7)).strftime("%Y-%m-%d")
+    now = datetime.now(timezone.utc)
+    start = now.strftime("%Y-%m-%d")
+    end = (now + timedelta(days=7)).strftime("%Y-%m-%d")
     url = f"https://statsapi.mlb.com/api/v1/schedule?sportId=1&startDate={start}&endDate={end}"
-    r = requests.get(url)
-    data = r.json()
-
-    schedule = []
-    for date in data.get("dates", []):
-        for game in date.get("games", []):
-            schedule.append({
-                "game_id": game.get("gamePk"),
-                "date": game.get("gameDate"),
-                "home_team": game.get("teams", {}).get("home", {}).get("team", {}).get("name"),
-                "away_team": game.get("teams", {}).get("away", {}).get("team", {}).get("name"),
-            })
+    # Stream the response: 7 days of games can be several MB, and ijson
+    # emits one game at a time instead of materializing the full tree.
+    r = SESSION.get(url, timeout=10, stream=True)
+
+    rows = (_schedule_row(game) for game in ijson.items(_json_stream(r), "dates.item.games.item"))
+    schedule = [row for row in rows if row is not None]
     upsert("schedule", schedule, ["game_id"])
 
 # --- Fetch team stats ---
+@dataclass(slots=True)
+class TeamStatRow:
+    # Slots instead of a per-row dict: fixed attribute table, no hash
+    # table per instance. Converted back to dicts only at upsert time.
+    season: int
+    team_id: int | None
+    team_name: str | None
+    updated_at: str
+    games_played: int | None = None
+    wins: int | None = None
+    losses: int | None = None
+    win_percentage: float | None = None
+    runs_scored: int | None = None
+    runs_allowed: int | None = None
+    home_runs: int | None = None
+    batting_avg: float | None = None
+    obp: float | None = None
+    slg: float | None = None
+    era: float | None = None
+    strikeouts: int | None = None
+    walks: int | None = None
+    stolen_bases: int | None = None
+    caught_stealing: int | None = None
+
+def _nzfloat(v):
+    return float(v or 0)
+
+# Per-group (attribute, source key, caster) tables, walked by one loop
+# below; a dict lookup on the group name replaces the per-split if/elif
+# string-compare chain. Groups not listed here (fielding) are skipped.
+TEAM_STAT_FIELDS = {
+    "hitting": (
+        ("games_played", "gamesPlayed", int),
+        ("runs_scored", "runs", int),
+        ("home_runs", "homeRuns", int),
+        ("batting_avg", "avg", _nzfloat),
+        ("obp", "obp", _nzfloat),
+        ("slg", "slg", _nzfloat),
+        ("stolen_bases", "stolenBases", int),
+        ("caught_stealing", "caughtStealing", int),
+    ),
+    "pitching": (
+        ("wins", "wins", int),
+        ("losses", "losses", int),
+        ("win_percentage", "winPercentage", _nzfloat),
+        ("era", "era", _nzfloat),
+        ("strikeouts", "strikeOuts", int),
+        ("walks", "baseOnBalls", int),
+        ("runs_allowed", "runs", int),
+    ),
+}
+
 def fetch_team_stats(season=None):
+    # One timestamp per run; reused for every row's updated_at below
+    # instead of a fresh datetime.now() per team.
+    now = datetime.now(timezone.utc)
+    now_iso = now.isoformat()
     if season is None:
-        season = datetime.now(timezone.utc).year
+        season = now.year
 
     url = f"https://statsapi.mlb.com/api/v1/teams/stats?season={season}&sportIds=1&group=hitting,pitching,fielding"
     print(f"[INFO] Fetching team stats for {season}")
-    resp = requests.get(url)
+    # Stream here too: three stat groups across 30 teams add up, and we
+    # only ever need one stats entry in memory at a time.
+    resp = SESSION.get(url, timeout=10, stream=True)
     resp.raise_for_status()
-    data = resp.json()
 
     team_stats = []
-    for team in data.get("stats", []):
+    for team in ijson.items(_json_stream(resp), "stats.item"):
         stat_splits = team.get("splits", [])
         
         # Get team info from the first split (they all have the same team info)
@@ -162,53 +399,24 @@ def fetch_team_stats(season=None):
             team_info = stat_splits[0].get("team", {})
 
         # We'll combine hitting and pitching into one row
-        row = {
-            "season": season,
-            "team_id": team_info.get("id"),
-            "team_name": team_info.get("name"),
-            "games_played": None,
-            "wins": None,
-            "losses": None,
-            "win_percentage": None,
-            "runs_scored": None,
-            "runs_allowed": None,
-            "home_runs": None,
-            "batting_avg": None,
-            "obp": None,
-            "slg": None,
-            "era": None,
-            "strikeouts": None,
-            "walks": None,
-            "stolen_bases": None,
-            "caught_stealing": None,
-            "updated_at": datetime.now(timezone.utc).isoformat()
-        }
+        row = TeamStatRow(
+            season=season,
+            team_id=team_info.get("id"),
+            team_name=team_info.get("name"),
+            updated_at=now_iso
+        )
 
         for split in stat_splits:
             group = split.get("group", {}).get("displayName", "").lower()
+            fields = TEAM_STAT_FIELDS.get(group)
+            if fields is None:
+                continue
             stats = split.get("stat", {})
-
-            if group == "hitting":
-                row["games_played"] = int(stats.get("gamesPlayed", 0))
-                row["runs_scored"] = int(stats.get("runs", 0))
-                row["home_runs"] = int(stats.get("homeRuns", 0))
-                row["batting_avg"] = float(stats.get("avg", 0) or 0)
-                row["obp"] = float(stats.get("obp", 0) or 0)
-                row["slg"] = float(stats.get("slg", 0) or 0)
-                row["stolen_bases"] = int(stats.get("stolenBases", 0))
-                row["caught_stealing"] = int(stats.get("caughtStealing", 0))
-
-            elif group == "pitching":
-                row["wins"] = int(stats.get("wins", 0))
-                row["losses"] = int(stats.get("losses", 0))
-                row["win_percentage"] = float(stats.get("winPercentage", 0) or 0)
-                row["era"] = float(stats.get("era", 0) or 0)
-                row["strikeouts"] = int(stats.get("strikeOuts", 0))
-                row["walks"] = int(stats.get("baseOnBalls", 0))
-                row["runs_allowed"] = int(stats.get("runs", 0))
+            for dest, src, cast in fields:
+                setattr(row, dest, cast(stats.get(src, 0)))
 
         # Only add rows that have valid team_id
-        if row["team_id"] is not None:
+        if row.team_id is not None:
             team_stats.append(row)
         else:
             print(f"[WARNING] Skipping team with no team_id: {row}")
@@ -218,12 +426,27 @@ def fetch_team_stats(season=None):
         print(f"[WARNING] No valid team stats to upsert")
         return
 
-    upsert("team_stats", team_stats, ["season", "team_id"])
+    upsert("team_stats", [asdict(row) for row in team_stats], ["season", "team_id"])
+
+# --- Fetcher registry / main runner ---
+FETCHERS = {
+    "games": fetch_games,
+    "standings": fetch_standings,
+    "player_stats": fetch_player_stats,
+    "schedule": fetch_schedule,
+    "team_stats": fetch_team_stats,
+}
 
-# --- Main runner ---
 if __name__ == "__main__":
-    fetch_games()
-    fetch_standings()
-    fetch_player_stats()
-    fetch_schedule()
-    fetch_team_stats()
\ No newline at end of file
+    # Run the fetchers named on the command line, or all of them.
+    names = sys.argv[1:] or list(FETCHERS)
+    unknown = [n for n in names if n not in FETCHERS]
+    if unknown:
+        print(f"[ERROR] Unknown fetcher(s): {', '.join(unknown)}. Choose from: {', '.join(FETCHERS)}")
+        sys.exit(1)
+    # The fetchers hit independent MLB endpoints and independent tables,
+    # so run them concurrently; the shared session and Supabase client
+    # are both safe for parallel requests. list() drains the iterator so
+    # any fetcher exception is re-raised here.
+    with ThreadPoolExecutor(max_workers=len(names)) as ex:
+        list(ex.map(lambda n: FETCHERS[n](), names))
\ No newline at end of file
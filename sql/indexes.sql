@@ -0,0 +1,16 @@
+-- Composite unique indexes backing the upsert on_conflict specs in
+-- fetch_mlb_data.py. Column order matches the on_conflict columns so
+-- Postgres can use the leftmost prefix and conflict detection stays
+-- O(log N) instead of degrading to a scan as the tables grow.
+--
+-- Run in the Supabase SQL editor. CONCURRENTLY avoids locking the
+-- tables while the index builds (cannot run inside a transaction).
+
+CREATE UNIQUE INDEX CONCURRENTLY IF NOT EXISTS standings_season_team_idx
+    ON standings (season, team_id);
+
+CREATE UNIQUE INDEX CONCURRENTLY IF NOT EXISTS team_stats_season_team_idx
+    ON team_stats (season, team_id);
+
+CREATE UNIQUE INDEX CONCURRENTLY IF NOT EXISTS player_season_stats_player_season_idx
+    ON player_season_stats (player_id, season);